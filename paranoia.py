@@ -1,17 +1,40 @@
+from collections import Counter
 from dataclasses import dataclass
+import gzip
 import json
 import os
 import random
-from typing import List, Set, Tuple
+from typing import List, Optional, Set, Tuple
 
 import click
 import fpdf
 import yaml
 
-from base64 import b64decode, b64encode
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from base64 import b64decode
 
 CONFIG_FILE_NAME = "paranoia.yml"
 ORGA_FILE_NAME = ".organization"
+CONFIG_CACHE_FILE_NAME = ".paranoia.yml.cache.json"
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# orjson is optional, and only used for the organization table
+if orjson is not None:
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+else:
+    _json_dumps = lambda obj: json.dumps(obj).encode()
+    _json_loads = json.loads
 
 
 @dataclass
@@ -50,6 +73,50 @@ def _error_out(desc: str):
     raise click.exceptions.Exit(2)
 
 
+def _load_config(root_dir: str):
+    config_file_path = os.path.join(root_dir, CONFIG_FILE_NAME)
+    cache_file_path = os.path.join(root_dir, CONFIG_CACHE_FILE_NAME)
+
+    if not os.path.exists(config_file_path):
+        raise click.FileError(config_file_path, "main configuration file not found")
+
+    # size as well as mtime, since copies can keep the old mtime (cp -p etc.)
+    config_stat = os.stat(config_file_path)
+    mtime, size = config_stat.st_mtime_ns, config_stat.st_size
+
+    # reuse the parsed config if the yaml file has not changed since
+    try:
+        with open(cache_file_path, encoding="utf-8") as cache_file:
+            cache = json.load(cache_file)
+        if cache["mtime"] == mtime and cache["size"] == size:
+            return cache["data"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    with click.open_file(config_file_path, encoding="utf-8") as config_file:
+        paranoia_file = yaml.load(config_file, SafeLoader)
+
+    # the cache is best-effort, a failure to write it is not an error. configs
+    # json can not represent (e.g. yaml dates) are simply never cached
+    try:
+        cache_ser = json.dumps({"mtime": mtime, "size": size, "data": paranoia_file})
+    except (TypeError, ValueError):
+        return paranoia_file
+
+    tmp_file_path = cache_file_path + ".tmp"
+    try:
+        with open(tmp_file_path, "w", encoding="utf-8") as cache_file:
+            cache_file.write(cache_ser)
+        os.replace(tmp_file_path, cache_file_path)
+    except OSError:
+        try:
+            os.remove(tmp_file_path)
+        except OSError:
+            pass
+
+    return paranoia_file
+
+
 ############################################################
 #
 # ORGANIZATION PART
@@ -57,24 +124,23 @@ def _error_out(desc: str):
 ############################################################
 
 
-def _create_orga(root_dir, paranoia_file):
-    fields = [DataField(**conf) for conf in paranoia_file["fields"]]
+def _create_orga(root_dir, fields: List[DataField]):
+    name_counts = Counter()
+    player_fields = []
+    for field in fields:
+        name_counts[field.name] += 1
+        if field.is_player:
+            player_fields.append(field)
 
     # check all names unique
-    if len({field.name for field in fields}) != len(fields):
-        duplicates = ", ".join(
-            {
-                field.name
-                for field in fields
-                if any(f2.name == field.name for f2 in fields if f2 is not field)
-            }
-        )
+    if len(name_counts) != len(fields):
+        duplicates = ", ".join(name for name, count in name_counts.items() if count > 1)
         _error_out("duplicate field names: " + duplicates)
 
-    if len([0 for field in fields if field.is_player]) != 1:
+    if len(player_fields) != 1:
         _error_out("exactly one field must have `is_player' set")
 
-    player_field = [field.name for field in fields if field.is_player][0]
+    player_field = player_fields[0].name
 
     field_data = {}
     for field in fields:
@@ -84,7 +150,7 @@ def _create_orga(root_dir, paranoia_file):
             raise click.FileError(data_path, f"data for {field.name} not found")
 
         with click.open_file(data_path, encoding="utf-8") as f:
-            field_data[field.name] = [line.strip() for line in f if line.strip()]
+            field_data[field.name] = [line for line in map(str.strip, f) if line]
 
     player_count = len(field_data[player_field])
 
@@ -103,33 +169,30 @@ def _create_orga(root_dir, paranoia_file):
             )
 
     # create the orga lists
-    id_list = list(range(player_count))
-    random.shuffle(id_list)
+    id_list = random.sample(range(player_count), player_count)
 
-    player_list = list(field_data[player_field])
-    random.shuffle(player_list)
+    player_list = random.sample(field_data[player_field], player_count)
 
-    target_list = [*player_list[1:], player_list[0]]
+    # each player targets the next one in the shuffled order
+    target_list = list(player_list)
+    target_list.append(target_list.pop(0))
 
     other_lists = []
     for field in fields:
         if field.is_player:
             continue
 
-        data = list(field_data[field.name])
-        if field.can_repeat and field.can_skip:
-            data = random.sample(data, k=player_count)
-        elif len(data) < player_count:
-            data.extend(random.choices(data, k=player_count - len(data)))
-        elif len(data) > player_count:
-            data = random.sample(data, k=player_count)
-        random.shuffle(data)
-        other_lists.append(data)
+        # pad short fields with repeats, then a single sample both picks the
+        # entries of long fields and shuffles the result
+        data = field_data[field.name]
+        if len(data) < player_count:
+            data = data + random.choices(data, k=player_count - len(data))
+        other_lists.append(random.sample(data, k=player_count))
 
     orga_table = [id_list, player_list, target_list, *other_lists]
 
     # transpose
-    orga_table = [[col[i] for col in orga_table] for i in range(player_count)]
+    orga_table = list(zip(*orga_table))
 
     orga_table.sort()
 
@@ -141,15 +204,18 @@ def _create_orga(root_dir, paranoia_file):
 
 def _print_orga(orga_table):
     orga_table = [[str(x) for x in y] for y in orga_table]
-    measure = click.formatting.measure_table(orga_table)
+    widths = [max(map(len, col)) + 4 for col in zip(*orga_table)]
     for row in orga_table:
-        for i, col in enumerate(row):
-            col += " " * (measure[i] - len(col) + 4)
-            print(col, end="")
-        print()
+        click.echo("".join(col.ljust(w) for col, w in zip(row, widths)))
 
 
-def _do_organize(root_dir: str, force: bool, print_table: bool):
+def _do_organize(
+    root_dir: str,
+    force: bool,
+    print_table: bool,
+    paranoia_file: Optional[dict] = None,
+    fields: Optional[List[DataField]] = None,
+):
     config_file_path = os.path.join(root_dir, CONFIG_FILE_NAME)
     orga_file_path = os.path.join(root_dir, ORGA_FILE_NAME)
 
@@ -159,20 +225,21 @@ def _do_organize(root_dir: str, force: bool, print_table: bool):
     if os.path.exists(orga_file_path) and not force:
         _error_out("game already organized, and --force not specified")
 
-    with click.open_file(config_file_path, encoding="utf-8") as config_file:
-        paranoia_file = yaml.load(config_file, yaml.SafeLoader)
+    # callers that already loaded the config can pass it in
+    if paranoia_file is None:
+        paranoia_file = _load_config(root_dir)
+    if fields is None:
+        fields = [DataField(**conf) for conf in paranoia_file["fields"]]
 
-    orga_table = _create_orga(root_dir, paranoia_file)
+    orga_table = _create_orga(root_dir, fields)
 
     if print_table:
         confirmation = click.confirm("Are you sure you want to print the table?")
         if confirmation:
             _print_orga(orga_table)
 
-    with click.open_file(orga_file_path, "w") as orga_file:
-        orga_ser = json.dumps(orga_table)
-        orga_ser = b64encode(orga_ser.encode()).decode()
-        orga_file.write(orga_ser)
+    with click.open_file(orga_file_path, "wb") as orga_file:
+        orga_file.write(gzip.compress(_json_dumps(orga_table)))
 
 
 @root_dir_argument()
@@ -224,29 +291,100 @@ def _line_height(font_size, line_spacing):
     return int(font_size) * PT_TO_MM * float(line_spacing)
 
 
+class _BufferedFPDF(fpdf.FPDF):
+    """fpdf 1.x builds the output document by appending to a `str`, which is
+    quadratic in the document size. Collect it in a `bytearray` instead."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buffer = bytearray()
+
+    def _out(self, s):
+        # page contents stay `str`, fpdf does text replacements on them
+        if self.state == 2:
+            return super()._out(s)
+        if isinstance(s, str):
+            s = s.encode("latin1")
+        elif not isinstance(s, (bytes, bytearray)):
+            s = str(s).encode("latin1")
+        self.buffer += s
+        self.buffer += b"\n"
+
+    def output(self, name="", dest=""):
+        if self.state < 3:
+            self.close()
+        dest = dest.upper() or ("F" if name else "I")
+        if dest == "F":
+            with open(name, "wb") as f:
+                f.write(self.buffer)
+            return ""
+        self.buffer = self.buffer.decode("latin1")
+        return super().output(name, dest)
+
+
+# fpdf2 already buffers its output efficiently
+_FPDF = fpdf.FPDF if int(fpdf.__version__.split(".")[0]) >= 2 else _BufferedFPDF
+
+
 def _create_pdf(
     orga_table: List[Tuple[int, str, str]],
     config: Config,
     fields: List[DataField],
     only: Set[int],
 ):
-    pdf = fpdf.FPDF("P", "mm", "A5")
+    pdf = _FPDF("P", "mm", "A5")
+
+    # page geometry and fonts are the same for every page
+    margin = int(config.print_margin)
+
+    w_mid = pdf.w / 2
+    h_mid = pdf.h / 2
+    cell_w = w_mid - margin * 2
 
+    cover_font = (
+        config.cover_font_name,
+        config.cover_font_style,
+        int(config.cover_font_size),
+    )
+    field_font = (
+        config.field_font_name,
+        config.field_font_style,
+        int(config.field_font_size),
+    )
+    value_font = (
+        config.value_font_name,
+        config.value_font_style,
+        int(config.value_font_size),
+    )
+    id_font = (
+        config.id_font_name,
+        config.id_font_style,
+        int(config.id_font_size),
+    )
+
+    cover_lh = _line_height(config.cover_font_size, config.cover_line_spacing)
+    field_lh = _line_height(config.field_font_size, config.field_line_spacing)
+    value_lh = _line_height(config.value_font_size, config.value_line_spacing)
+
+    cover_spacing = float(config.cover_font_size) * PT_TO_MM * 0.5
+    value_spacing = float(config.value_font_size) * PT_TO_MM * 0.5
+
+    id_y = h_mid - margin - int(config.id_font_size) * PT_TO_MM
+    id_h = float(config.value_font_size) * PT_TO_MM * 0.5
+
+    # blank leading page, so the first target is not visible on the stack
     pdf.add_page()
 
     for row in orga_table:
+        if only and row[0] not in only:
+            continue
+
         row_id, person_name, *other = row
         assert len(other) == len(fields)
 
-        if only and row_id not in only:
-            continue
-
         pdf.add_page()
 
-        margin = int(config.print_margin)
-
-        w_mid = pdf.w / 2
-        h_mid = pdf.h / 2
+        label = f"{config.id_prefix}{row_id}"
 
         if config.print_fold_lines:
             pdf.line(0, h_mid, pdf.w, h_mid)
@@ -255,107 +393,81 @@ def _create_pdf(
         # format lhs
 
         pdf.set_xy(margin, margin)
-        pdf.set_font(
-            config.cover_font_name,
-            config.cover_font_style,
-            int(config.cover_font_size),
-        )
+        pdf.set_font(*cover_font)
 
         pdf.multi_cell(
-            w=w_mid - margin * 2,
-            h=_line_height(config.cover_font_size, config.cover_line_spacing),
+            w=cell_w,
+            h=cover_lh,
             txt=person_name,
             align="C",
         )
 
-        pdf.set_y(pdf.y + float(config.cover_font_size) * PT_TO_MM * 0.5)
+        pdf.set_y(pdf.y + cover_spacing)
 
-        pdf.set_xy(margin, h_mid - margin - int(config.id_font_size) * PT_TO_MM)
-        pdf.set_font(
-            config.id_font_name,
-            config.id_font_style,
-            int(config.id_font_size),
-        )
-        pdf.multi_cell(
-            w=w_mid - margin * 2,
-            h=float(config.value_font_size) * PT_TO_MM * 0.5,
-            txt=f"{config.id_prefix}{row_id}",
-        )
+        pdf.set_xy(margin, id_y)
+        pdf.set_font(*id_font)
+        pdf.cell(w=cell_w, h=id_h, txt=label)
 
         # format rhs
         pdf.set_y(margin)
         for field, value in zip(fields, other):
             # field name
             pdf.set_x(margin + w_mid)
-            pdf.set_font(
-                config.field_font_name,
-                config.field_font_style,
-                int(config.field_font_size),
-            )
+            pdf.set_font(*field_font)
             pdf.multi_cell(
-                w=w_mid - margin * 2,
-                h=_line_height(config.field_font_size, config.field_line_spacing),
+                w=cell_w,
+                h=field_lh,
                 txt=field.name,
             )
 
             # value
             pdf.set_x(margin + w_mid)
-            pdf.set_font(
-                config.value_font_name,
-                config.value_font_style,
-                int(config.value_font_size),
-            )
+            pdf.set_font(*value_font)
             pdf.multi_cell(
-                w=w_mid - margin * 2,
-                h=_line_height(config.value_font_size, config.value_line_spacing),
+                w=cell_w,
+                h=value_lh,
                 txt=value,
             )
 
             # spacing
-            pdf.set_y(pdf.y + float(config.value_font_size) * PT_TO_MM * 0.5)
+            pdf.set_y(pdf.y + value_spacing)
 
-        pdf.set_xy(margin + w_mid, h_mid - margin - int(config.id_font_size) * PT_TO_MM)
-        pdf.set_font(
-            config.id_font_name,
-            config.id_font_style,
-            int(config.id_font_size),
-        )
-        pdf.multi_cell(
-            w=w_mid - margin * 2,
-            h=float(config.value_font_size) * PT_TO_MM * 0.5,
-            txt=f"{config.id_prefix}{row_id}",
-        )
+        pdf.set_xy(margin + w_mid, id_y)
+        pdf.set_font(*id_font)
+        pdf.cell(w=cell_w, h=id_h, txt=label)
 
-    pdf.output("output.pdf", "F")
+    # written straight from the output buffer, without an intermediate copy
+    pdf.output("output.pdf")
 
 
 @root_dir_argument()
 @click.option("--only")
 @paranoia.command()
 def print(root_dir: str, only: str):
-    config_file_path = os.path.join(root_dir, CONFIG_FILE_NAME)
     orga_file_path = os.path.join(root_dir, ORGA_FILE_NAME)
 
-    if not os.path.exists(config_file_path):
-        raise click.FileError(config_file_path, "main configuration file not found")
-
-    with click.open_file(config_file_path, encoding="utf-8") as config_file:
-        paranoia_file = yaml.load(config_file, yaml.SafeLoader)
+    paranoia_file = _load_config(root_dir)
+    fields = [DataField(**field) for field in paranoia_file["fields"]]
 
     if not os.path.exists(orga_file_path):
         if click.confirm("Game not organized. Organize now?"):
-            _do_organize(root_dir, False, False)
+            _do_organize(root_dir, False, False, paranoia_file, fields)
         else:
             _error_out("game not organized")
 
-    with click.open_file(orga_file_path) as orga_file:
-        orga_table = json.loads(b64decode(orga_file.read().encode()).decode())
+    with click.open_file(orga_file_path, "rb") as orga_file:
+        orga_ser = orga_file.read()
+
+    # organizations written by older versions are base64 encoded
+    if orga_ser.startswith(GZIP_MAGIC):
+        orga_table = _json_loads(gzip.decompress(orga_ser))
+    else:
+        orga_table = _json_loads(b64decode(orga_ser))
 
     config = Config(**paranoia_file["config"])
-    fields = [DataField(**field) for field in paranoia_file["fields"]]
 
     if only:
-        only = set(int(i) for i in only.split(","))
+        only = frozenset(map(int, only.split(",")))
 
     _create_pdf(orga_table, config, fields, only)
 